@@ -129,7 +129,6 @@ class MSCCLProgram:
         # self.chunk_dag._complete_metadata()
         # self.chunk_dag.channel_assignment()
         # self.chunk_dag.lower_instr_dag(self.instr_dag)
-        self.instr_dag.convert_set_list()  # Pre-emptively convert sets to lists
         if self.instr_fusion:
             self.instr_dag.optimize()
         self.instr_dag._complete_metadata()
@@ -2,7 +2,8 @@
 # Licensed under the MIT License.
 
 from abc import ABC, abstractmethod
-from collections import defaultdict
+from collections import defaultdict, deque
+from operator import itemgetter
 
 from msccl.language.buffer import Buffer
 from msccl.language.types import ChunkRef, Gpu, Instruction, Op, ReplicationPolicy, Threadblock
@@ -10,52 +11,51 @@ from msccl.language.types import ChunkRef, Gpu, Instruction, Op, ReplicationPoli
 
 def remove_op(op: Op):
     for p in op.prev:
-        p.next.remove(op)
-        p.next += op.next
-        p.next = list(set(p.next))
+        p.next.discard(op)
+        p.next |= op.next
 
     for n in op.next:
-        n.prev.remove(op)
-        n.prev = op.prev.union(n.prev)
+        n.prev.discard(op)
+        n.prev |= op.prev
 
-    op.next = []
-    op.prev = []
+    op.next = set()
+    op.prev = set()
 
 
 def merge_op(op: Op, other_op: Op):
-    if other_op in op.next:
-        op.next.remove(other_op)
-        other_op.prev.remove(op)
+    op.next.discard(other_op)
+    other_op.prev.discard(op)
     for p in other_op.prev:
-        p.next.remove(other_op)
-        p.next.append(op)
+        p.next.discard(other_op)
+        p.next.add(op)
 
     for n in other_op.next:
-        n.prev.remove(other_op)
+        n.prev.discard(other_op)
         n.prev.add(op)
 
-    op.prev = op.prev.union(other_op.prev)
-    op.next = list(set(op.next + other_op.next))
+    op.prev |= other_op.prev
+    op.next |= other_op.next
 
 
 def circular_dep_after_merge(op: Op, other_op: Op):
+    # A direct edge that is the only way out of op or the only way into other_op cannot close a cycle
+    if other_op in op.next and (len(op.next) == 1 or len(other_op.prev) == 1):
+        return False
     root = set([op, other_op])
-    frontier = set(op.next)
-    if other_op in frontier:
-        frontier.remove(other_op)
-    frontier = list(frontier.union(other_op.next))
-    while len(frontier) > 0:
-        current = frontier[0]
+    seen = op.next | other_op.next
+    seen.discard(other_op)
+    # Depth-first so that a path back to the root is found without expanding the whole frontier
+    stack = list(seen)
+    while len(stack) > 0:
+        current = stack.pop()
         for n in current.next:
             # The root node will be visited again if there is a circular dependency
             if n in root:
                 return True
-            frontier.append(n)
-        frontier = frontier[1:]
-
-
-def same_tb(op1: Op, op2: Op):
-    return op1.tb == op2.tb and op1.channel == op2.channel
+            if n not in seen:
+                seen.add(n)
+                stack.append(n)
+    return False
 
 
 def same_count(op1: Op, op2: Op):
@@ -82,14 +82,21 @@ def same_chan_type(op1: Op, op2: Op):
     return op1.channel_type == op2.channel_type
 
 
+# Ops with equal keys share tb, channel, count and dst slot
+# Cached by the fusion walk rather than on the op, tb assignment reassigns tb and channel after optimize
+def fusion_key(op: Op):
+    return (op.tb, op.channel, op.cnt(), op.dst.buffer, op.dst.index)
+
+
 class InstructionDAG(ABC):
     def __init__(self, num_ranks, buffers):
         self.num_ranks = num_ranks
         self.buffers = buffers
         # State for the actual instruction DAG
         self.operations = {}  # slot -> operations
-        self.last_writer = {}  # slot -> last writing op
-        self.last_readers = defaultdict(list)  # slot -> list of last reading ops
+        self.slot_bases = {}  # (rank, buffer) -> first slot id of the buffer
+        self.last_writer = {}  # slot id -> last writing op
+        self.last_readers = defaultdict(list)  # slot id -> list of last reading ops
         # State for the MSCCL-IR
         self.tbs = []
         for _ in range(num_ranks):
@@ -98,29 +105,36 @@ class InstructionDAG(ABC):
         self.num_channels = [1] * num_ranks
         self.tb_steps = [{} for _ in range(num_ranks)]
 
+    # InstructionDAG helper - slots are tracked by an int id, slot (rank, buffer, index) is slot_base(rank, buffer) + index
+    def _slot_base(self, rank, buffer):
+        key = (rank, buffer)
+        base = self.slot_bases.get(key)
+        if base is None:
+            base = self.slot_bases[key] = len(self.slot_bases) << 32
+        return base
+
     # InstructionDAG helper - identifies the dependencies for a write-type operation (recv, copy, rrc, reduce)
     def _write(self, rank, buffer, index, size, op, read=False):
         prev_ops = set()
+        base = self._slot_base(rank, buffer)
         for i in range(index, index + size):
-            slot = (rank, buffer, i)
+            slot = base + i
             if read:
                 assert slot in self.last_writer, f"Destination slot has never been written before a reduce {op}"
 
-            # First write to this slot
-            if slot not in self.operations:
-                self.operations[slot] = op
-
             # If there are active readers - these are the previous operations
             # Else the previous operation is the last write (if there is one)
-            readers = self.last_readers[slot]
-            if len(readers) > 0:
+            readers = self.last_readers.pop(slot, None)
+            if readers:
                 prev_ops.update(readers)
             elif slot in self.last_writer:
                 prev_ops.add(self.last_writer[slot])
+            else:
+                # First write to this slot
+                self.operations[(rank, buffer, i)] = op
 
-            # Set the last_writer to this op, and clear all readers
+            # Set the last_writer to this op, readers were cleared above
             self.last_writer[slot] = op
-            self.last_readers[slot] = []
 
         # Update the next pointer of the previous ops
         for prev_op in prev_ops:
@@ -130,8 +144,9 @@ class InstructionDAG(ABC):
     # InstructionDAG helper - identifies the dependencies for read-type operations (send, copy, reduce)
     def _read(self, rank, buffer, index, size, op):
         prev_ops = set()
+        base = self._slot_base(rank, buffer)
         for i in range(index, index + size):
-            slot = (rank, buffer, i)
+            slot = base + i
             assert slot in self.last_writer, f"Slot has never been written before a read-type {op}"
             # The previous operation for a reader is the last write to the slot
             writer = self.last_writer[slot]
@@ -144,28 +159,32 @@ class InstructionDAG(ABC):
             op.prev.add(prev_op)
 
     def _infer_dependencies(self):
+        visited = set()
         for slot, ops in self.operations.items():
-            frontier = [ops]
+            frontier = deque([ops])
             while len(frontier) > 0:
-                op = frontier[0]
+                op = frontier.popleft()
+                if op in visited:
+                    continue
+                visited.add(op)
                 # Dependencies for every op is the same as the ops that are stored in prev
                 # Filter out dependencies that are satisified by tbs executing ops sequentially
                 # If multiple dependent ops from the same tb keep the one that happens last
                 depends = {}
-                for dep_op in list(op.prev):
+                for dep_op in op.prev:
                     if dep_op.inst != Instruction.start:
                         tb = dep_op.tb
                         if tb not in depends or dep_op.step > depends[tb].step:
                             depends[tb] = dep_op
                 op.depends = list(depends.values())
-                frontier = frontier[1:] + op.next
+                frontier.extend(op.next)
 
     # Convert local scratch buffers to index into one global scratch buffer
-    def _lower_chunk(self, chunk):
+    # scratch_bases maps (rank, buffer) to the global buffer and offset of that scratch buffer
+    def _lower_chunk(self, chunk, scratch_bases):
         if chunk is not None and chunk.buffer is not Buffer.input and chunk.buffer is not Buffer.output:
-            buffer = self.buffers[chunk.rank][chunk.buffer].get_buffer()
-            index = self.buffers[chunk.rank][chunk.buffer].get_global_index(chunk.index)
-            return ChunkRef(chunk.rank, buffer, index, chunk.size)
+            buffer, offset = scratch_bases[(chunk.rank, chunk.buffer)]
+            return ChunkRef(chunk.rank, buffer, offset + chunk.index, chunk.size)
         return chunk
 
     # Assigns each scratch buffer an offset into the global scratch buffer
@@ -177,19 +196,40 @@ class InstructionDAG(ABC):
                     buf.set_offset(offset)
                     offset += buf.instance_size() * instances
 
+    # Length of one instance of every (rank, buffer), which is the stride between replicated instances
+    def _get_buffer_lens(self):
+        buffer_lens = {}
+        for rank, rank_buffers in enumerate(self.buffers):
+            for key, buf in rank_buffers.items():
+                if key is not Buffer.input and key is not Buffer.output:
+                    buffer_lens[(rank, key)] = buf.instance_size()
+                else:
+                    buffer_lens[(rank, key)] = len(buf)
+        return buffer_lens
+
     # Preprocess the threadblocks for lowering into xml
     def _lower_tbs(self):
+        scratch_bases = {}
+        for rank, rank_buffers in enumerate(self.buffers):
+            for key, buf in rank_buffers.items():
+                if key is not Buffer.input and key is not Buffer.output:
+                    scratch_bases[(rank, key)] = (buf.get_buffer(), buf.get_global_index(0))
+
+        step = itemgetter(1)
         gpus = []
         for rank, rank_tbs in enumerate(self.instanced_tbs):
             lowered_tbs = {}
             for tbid, tb in rank_tbs.items():
                 for op in tb.ops:
-                    op.src = self._lower_chunk(op.src)
-                    op.dst = self._lower_chunk(op.dst)
-                    srcs = sorted(op.srcs, key=lambda x: x[1])
-                    dsts = sorted(op.dsts, key=lambda x: x[1])
-                    op.srcs = [self._lower_chunk(src[0]) for src in srcs]
-                    op.dsts = [self._lower_chunk(dst[0]) for dst in dsts]
+                    op.src = self._lower_chunk(op.src, scratch_bases)
+                    op.dst = self._lower_chunk(op.dst, scratch_bases)
+                    # srcs/dsts are (chunk, step) pairs appended mostly in step order, most ops have at most one
+                    if len(op.srcs) > 1:
+                        op.srcs.sort(key=step)
+                    if len(op.dsts) > 1:
+                        op.dsts.sort(key=step)
+                    op.srcs = [self._lower_chunk(src[0], scratch_bases) for src in op.srcs]
+                    op.dsts = [self._lower_chunk(dst[0], scratch_bases) for dst in op.dsts]
                 lowered_tbs[tbid] = tb
             gpus.append(Gpu(rank, list(lowered_tbs.values())))
         return gpus
@@ -199,28 +239,40 @@ class InstructionDAG(ABC):
         slot = (rank, buffer, index)
         op = Op(Instruction.start, rank, ref, ref, next=set(), prev=set(), chunk_step=-1)
         self.operations[slot] = op
-        self.last_writer[slot] = op
+        self.last_writer[self._slot_base(rank, buffer) + index] = op
 
+    # Returns every op reachable from the roots of the DAG in topological order
+    # prev/next stay as sets, only the returned collection is ordered
     def convert_set_list(self):
-        ops = []
-        visited = set()
+        frontier = deque()
         for slot, op in self.operations.items():
             if op.inst == Instruction.start:
-                op.next = list(op.next)
-                for o in op.next:
-                    ops.append(o)
+                frontier.extend(op.next)
             elif op.inst != Instruction.copy:
-                ops.append(op)
-
-            while len(ops) > 0:
-                op = ops[0]
-                if op not in visited:
-                    visited.add(op)
-                    op.next = list(op.next)
-                    ops = ops[1:] + op.next
-                else:
-                    ops = ops[1:]
-        return visited
+                frontier.append(op)
+
+        # Discover the reachable ops and count the edges between them
+        in_degree = {}
+        while len(frontier) > 0:
+            op = frontier.popleft()
+            if op not in in_degree:
+                in_degree[op] = 0
+                frontier.extend(op.next)
+        for op in in_degree:
+            for n in op.next:
+                in_degree[n] += 1
+
+        frontier.extend(op for op, degree in in_degree.items() if degree == 0)
+        ordered = []
+        while len(frontier) > 0:
+            op = frontier.popleft()
+            ordered.append(op)
+            for n in op.next:
+                in_degree[n] -= 1
+                if in_degree[n] == 0:
+                    frontier.append(n)
+        assert len(ordered) == len(in_degree), "Circular dependency in the instruction DAG"
+        return tuple(ordered)
 
     def lower_pt1(self, instances: int):
         self._infer_dependencies()
@@ -302,100 +354,107 @@ class MscclInstructionDAG(InstructionDAG):
         return op
 
     def optimize(self):
-        self._optimize_rrcs_rrs()
-        self._optimize_rcs()
+        self._optimize_rcs_rrcs_rrs()
 
     # Completes metadata for chunk_steps (number of steps from a start op) and priority (number of steps to the last op)
     def _complete_metadata(self):
-        def dfs(op, cs):
-            op.chunk_step = max(op.chunk_step, cs + 1)
-
-            if len(op.next) == 0 and op.recv_match is None:
-                op.priority = 0
-            else:
-                for o in op.next:
-                    dfs(o, op.chunk_step)
-                # Priority = +1 of the highest priority child
-                if len(op.next) > 0:
-                    highest_next_priority = max([x.priority + 1 for x in op.next])
-                    op.priority = max(highest_next_priority, op.priority)
-                if op.is_send():
-                    dfs(op.recv_match, op.chunk_step)
-                    op.priority = max(op.priority, op.recv_match.priority + 1)
-
-        for chunk, op in self.operations.items():
-            if op.inst == Instruction.start:
-                dfs(op, -2)  # Start instructions should start at -1
+        # Children of an op are the ops in next, plus the recv_match edge that only sends carry
+        # Collect the children of every op reachable from a start op and count incoming edges
+        roots = [op for op in self.operations.values() if op.inst == Instruction.start]
+        children = {}
+        in_degree = defaultdict(int)
+        frontier = deque(roots)
+        while len(frontier) > 0:
+            op = frontier.popleft()
+            if op in children:
+                continue
+            children[op] = list(op.next)
+            if op.recv_match is not None:
+                children[op].append(op.recv_match)
+            for child in children[op]:
+                in_degree[child] += 1
+                frontier.append(child)
+
+        # Topologically order the ops, chunk_step = +1 of the highest chunk_step parent
+        # Start instructions are at -1
+        ordered = []
+        frontier = deque(roots)
+        while len(frontier) > 0:
+            op = frontier.popleft()
+            ordered.append(op)
+            for child in children[op]:
+                child.chunk_step = max(child.chunk_step, op.chunk_step + 1)
+                in_degree[child] -= 1
+                if in_degree[child] == 0:
+                    frontier.append(child)
+        assert len(ordered) == len(children), "Circular dependency in the instruction DAG"
+
+        # Priority = +1 of the highest priority child, ops without children have priority 0
+        for op in reversed(ordered):
+            op.priority = max((child.priority + 1 for child in children[op]), default=0)
 
     # Given the set of operations that operate over a particular slot (rank, buffer, idx) fixed
     # Try and replace operations with pipelined ops like receive copy send (rcs)
     # or receive reduce send (rrs) and receive reduce copy send (rrcs)
+    # All rules are tried in a single walk over the DAG
     # Rules:
     # recv-copy-send
     # recv(src, sbuf, si, _, _, _ ) send(_, _, _, dst, dbuf, di) -> recv_copy_send(src, sbuf, si, dst, dbuf, di)
-    def _optimize_rcs(self):
-        for slot, ops in self.operations.items():
-            frontier = [ops]
-            while len(frontier) > 0:
-                op = frontier[0]
-                for next_op in op.next:
-                    if (
-                        op.inst == Instruction.recv
-                        and next_op.inst == Instruction.send
-                        and same_tb(op, next_op)
-                        and same_count(op, next_op)
-                        and same_buf_dst(op, next_op)
-                    ):
-                        # recv -> rcs, remove send
-                        op.inst = Instruction.recv_copy_send
-                        op.dst = next_op.dst
-                        next_op.recv_match.send_match = op
-                        op.recv_match = next_op.recv_match
-                        remove_op(next_op)
-                        break
-                frontier = frontier[1:] + op.next
-
     # recv-reduce-send - A rrc followed by a send that gets overwritten
     # rrc(src, sbuf, si, ...) send(_, _, _, dst, dbuf, di) recv(_, _, _, dst, dbuf, di)
     # recv-reduce-copy-send - A rrc followed by a send that does not get overwritten
     # rrc(src, sbuf, si, ...) send(_, _, _, dst, dbuf, di)
-    def _optimize_rrcs_rrs(self):
-        # RRC/S -> RRS
+    def _optimize_rcs_rrcs_rrs(self):
+        # tb and channel are fixed during the walk and dst is the only field a rewrite reassigns
+        # so a key stays valid until its op's dst changes
+        keys = {}
+
+        def cached_key(op):
+            key = keys.get(op)
+            if key is None:
+                key = keys[op] = fusion_key(op)
+            return key
+
+        visited = set()
         for slot, ops in self.operations.items():
-            frontier = [ops]
+            frontier = deque([ops])
             while len(frontier) > 0:
-                op = frontier[0]
-                if len(op.next) == 1:
-                    next_op = op.next[0]
-                    if len(next_op.next) == 1:
-                        nnext_op = next_op.next[0]
-                        if (
-                            op.inst == Instruction.recv_reduce_copy
-                            and next_op.inst == Instruction.send
-                            and nnext_op.inst is Instruction.recv
-                            and same_tb(op, next_op)
-                            and same_count(op, next_op)
-                            and same_buf_dst(op, next_op)
-                        ):
-                            op.inst = Instruction.recv_reduce_send
+                op = frontier.popleft()
+                if op in visited:
+                    continue
+                visited.add(op)
+                if op.inst == Instruction.recv:
+                    key = cached_key(op)
+                    for next_op in op.next:
+                        if next_op.inst == Instruction.send and cached_key(next_op) == key:
+                            # recv -> rcs, remove send
+                            op.inst = Instruction.recv_copy_send
                             op.dst = next_op.dst
+                            op.reset_cnt()
+                            keys.pop(op, None)
                             next_op.recv_match.send_match = op
                             op.recv_match = next_op.recv_match
                             remove_op(next_op)
-
-                    if (
-                        op.inst == Instruction.recv_reduce_copy
-                        and next_op.inst == Instruction.send
-                        and same_tb(op, next_op)
-                        and same_count(op, next_op)
-                        and same_buf_dst(op, next_op)
-                    ):
-                        op.inst = Instruction.recv_reduce_copy_send
+                            break
+                elif op.inst == Instruction.recv_reduce_copy and len(op.next) == 1:
+                    next_op = next(iter(op.next))
+                    if next_op.inst == Instruction.send and cached_key(op) == cached_key(next_op):
+                        # rrc -> rrs if the send is only followed by a recv that overwrites it, else rrc -> rrcs
+                        # The recv may already have been rewritten to an rcs earlier in the walk
+                        if len(next_op.next) == 1 and next(iter(next_op.next)).inst in (
+                            Instruction.recv,
+                            Instruction.recv_copy_send,
+                        ):
+                            op.inst = Instruction.recv_reduce_send
+                        else:
+                            op.inst = Instruction.recv_reduce_copy_send
                         op.dst = next_op.dst
+                        op.reset_cnt()
+                        keys.pop(op, None)
                         next_op.recv_match.send_match = op
                         op.recv_match = next_op.recv_match
                         remove_op(next_op)
-                frontier = frontier[1:] + op.next
+                frontier.extend(op.next)
 
     # Automatically replicates the algorithm instance number of times
     # interleaved sets the replication policy
@@ -417,22 +476,30 @@ class MscclInstructionDAG(InstructionDAG):
         def is_scratch(buffer):
             return buffer != Buffer.input and buffer != Buffer.output
 
-        def get_new_index(rank, buffer, index, size, i):
+        buffer_lens = self._get_buffer_lens()
+
+        # Instance i of a chunk is at index base + stride * i
+        def get_instance_layout(ref):
             # Scratch buffers always use batched
-            if is_scratch(buffer):
-                buf_instance_len = self.buffers[rank][buffer].instance_size()
-                return buf_instance_len * i + index
+            if is_scratch(ref.buffer):
+                return ref.index, buffer_lens[(ref.rank, ref.buffer)]
             # If this is operating on the input/output buffer then replication strategy can be either interleaved or batched
             # This is to fit with the semantics of certain collectives
             elif replication_policy == ReplicationPolicy.interleaved:
-                return index * instances + i * size
+                return ref.index * instances, ref.size
             else:
-                return len(self.buffers[rank][buffer]) * i + index
+                return ref.index, buffer_lens[(ref.rank, ref.buffer)]
 
-        def get_instance_ref(ref):
-            iindex = get_new_index(ref.rank, ref.buffer, ref.index, ref.size, i)
-            iref = ChunkRef(ref.rank, ref.buffer, iindex, ref.size)
-            return iref
+        def get_instance_ref(ref, layout):
+            base, stride = layout
+            return ChunkRef(ref.rank, ref.buffer, base + stride * i, ref.size)
+
+        # The layouts do not depend on the instance so compute them once per op
+        layouts = {}
+        for rank_tbs in self.tbs:
+            for tb in rank_tbs.values():
+                for op in tb.ops:
+                    layouts[op] = (get_instance_layout(op.src), get_instance_layout(op.dst))
 
         max_channels = max(self.num_channels)
         for i in range(instances):
@@ -445,8 +512,9 @@ class MscclInstructionDAG(InstructionDAG):
                     itbid = tbid * instances + i
                     itb.ops = [None] * len(tb.ops)
                     for s, op in enumerate(tb.ops):
-                        isrc = get_instance_ref(op.src)
-                        idst = get_instance_ref(op.dst)
+                        src_layout, dst_layout = layouts[op]
+                        isrc = get_instance_ref(op.src, src_layout)
+                        idst = get_instance_ref(op.dst, dst_layout)
                         idepends = []
                         # Note: We don't need the fill out the rest of the metadata since replication is the last optimization
                         iop = Op(op.inst, op.rank, isrc, idst, idepends, op.step, itbid)
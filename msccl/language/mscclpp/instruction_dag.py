@@ -1,6 +1,7 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+from collections import deque
 
 from msccl.language.buffer import Buffer
 from msccl.language.types import Channel, ChannelType
@@ -189,11 +190,19 @@ class MscclppInstructionDAG(InstructionDAG):
                         chans.add(chan)
                 tb.channels = list(chans)
 
+    # Ops merged into another op during a pass are dropped from their threadblocks once the pass is done
+    def _remove_merged_ops(self, merged):
+        if len(merged) == 0:
+            return
+        for rank_tbs in self.tbs:
+            for tb in rank_tbs.values():
+                tb.ops = [op for op in tb.ops if op not in merged]
+
     def _optimize_redundant_signal_wait(self):
         # For packet ops, we can remove signal/wait
         for rank, rank_tbs in enumerate(self.tbs):
             for tbid, tb in rank_tbs.items():
-                queue = list(tb.ops)
+                queue = deque(tb.ops)
                 while len(queue) > 0:
                     op = queue[0]
                     if op.inst == Instruction.put_packet:
@@ -214,7 +223,7 @@ class MscclppInstructionDAG(InstructionDAG):
                                 break
                         if fused:
                             continue
-                    queue = queue[1:]
+                    queue.popleft()
 
     # rrc(_,_,_,dst,dbuf,di) rrc(_,_,_,dst,dbuf,di) -> rrc(list[src,sbuf,si], dst, dbuf, di)
     # signal(_,_,_,dst,dbuf,di) signal(_,_,_,dst,dbuf,di) -> signal(_,_,_,list[dst,dbuf,di])
@@ -222,16 +231,21 @@ class MscclppInstructionDAG(InstructionDAG):
     # reduce(_,_,_,dst,dbuf,di) reduce(_,_,_,dst,dbuf,di) -> reduce(list[src,sbuf,si], dst, dbuf, di)
     # reduce_packet(_,_,_,dst,dbuf,di) reduce_packet(_,_,_,dst,dbuf,di) -> reduce_packet(list[src,sbuf,si], dst, dbuf, di)
     def _optimize_rrc_r_signal_wait(self):
+        merged = set()
         for rank, rank_tbs in enumerate(self.tbs):
             for tbid, tb in rank_tbs.items():
-                queue = list(tb.ops)
+                queue = deque(op for op in tb.ops if op not in merged)
                 while len(queue) > 0:
                     op = queue[0]
+                    if op in merged:
+                        queue.popleft()
+                        continue
                     if op.inst == Instruction.read_reduce_copy:
                         fused = False
                         for next_op in op.next:
                             if (
                                 next_op.inst == Instruction.read_reduce_copy
+                                and next_op.tb == op.tb
                                 and same_count(op, next_op)
                                 and same_buf_dst(op, next_op)
                                 and same_chan_type(op, next_op)
@@ -246,8 +260,7 @@ class MscclppInstructionDAG(InstructionDAG):
                                     )
                                 )
                                 merge_op(op, next_op)
-                                tb.ops.remove(next_op)
-                                queue.remove(next_op)
+                                merged.add(next_op)
                                 fused = True
                                 break
                         if fused:
@@ -257,6 +270,7 @@ class MscclppInstructionDAG(InstructionDAG):
                         for next_op in op.next:
                             if (
                                 next_op.inst == Instruction.reduce
+                                and next_op.tb == op.tb
                                 and same_buf_dst(op, next_op)
                                 and same_chan_type(op, next_op)
                                 and not circular_dep_after_merge(op, next_op)
@@ -270,8 +284,7 @@ class MscclppInstructionDAG(InstructionDAG):
                                     )
                                 )
                                 merge_op(op, next_op)
-                                tb.ops.remove(next_op)
-                                queue.remove(next_op)
+                                merged.add(next_op)
                                 fused = True
                                 break
                         if fused:
@@ -281,6 +294,7 @@ class MscclppInstructionDAG(InstructionDAG):
                         for next_op in op.next:
                             if (
                                 next_op.inst == Instruction.reduce_packet
+                                and next_op.tb == op.tb
                                 and same_buf_dst(op, next_op)
                                 and same_chan_type(op, next_op)
                                 and not circular_dep_after_merge(op, next_op)
@@ -294,8 +308,7 @@ class MscclppInstructionDAG(InstructionDAG):
                                     )
                                 )
                                 merge_op(op, next_op)
-                                tb.ops.remove(next_op)
-                                queue.remove(next_op)
+                                merged.add(next_op)
                                 fused = True
                                 break
                         if fused:
@@ -305,6 +318,7 @@ class MscclppInstructionDAG(InstructionDAG):
                         for next_op in op.next:
                             if (
                                 next_op.inst == Instruction.signal
+                                and next_op.tb == op.tb
                                 and same_buf_src(op, next_op)
                                 and same_chan_type(op, next_op)
                                 and not circular_dep_after_merge(op, next_op)
@@ -326,8 +340,7 @@ class MscclppInstructionDAG(InstructionDAG):
                                     )
                                 )
                                 merge_op(op, next_op)
-                                tb.ops.remove(next_op)
-                                queue.remove(next_op)
+                                merged.add(next_op)
                                 fused = True
                                 break
                         if fused:
@@ -337,6 +350,7 @@ class MscclppInstructionDAG(InstructionDAG):
                         for next_op in op.next:
                             if (
                                 next_op.inst == Instruction.wait
+                                and next_op.tb == op.tb
                                 and same_buf_dst(op, next_op)
                                 and same_chan_type(op, next_op)
                                 and not circular_dep_after_merge(op, next_op)
@@ -358,27 +372,33 @@ class MscclppInstructionDAG(InstructionDAG):
                                     )
                                 )
                                 merge_op(op, next_op)
-                                tb.ops.remove(next_op)
-                                queue.remove(next_op)
+                                merged.add(next_op)
                                 fused = True
                                 break
                         if fused:
                             continue
-                    queue = queue[1:]
+                    queue.popleft()
+        self._remove_merged_ops(merged)
 
     # rrc(_,_,_,dst,dbuf,di) put(dst,dbuf,di,_,_,_) -> rrcs(_,_,_,_,_,_)
     # reduce(_,_,_,dst,dbuf,di) put(dst,dbuf,di,_,_,_) -> rs(_,_,_,_,_,_)
+    # reduce_packet(_,_,_,dst,dbuf,di) put_packet(dst,dbuf,di,_,_,_) -> rspkt(_,_,_,_,_,_)
     def _optimize_rrcs_rs(self):
+        merged = set()
         for rank, rank_tbs in enumerate(self.tbs):
             for tbid, tb in rank_tbs.items():
-                queue = list(tb.ops)
+                queue = deque(op for op in tb.ops if op not in merged)
                 while len(queue) > 0:
                     op = queue[0]
+                    if op in merged:
+                        queue.popleft()
+                        continue
                     if op.inst == Instruction.read_reduce_copy or op.inst == Instruction.read_reduce_copy_send:
                         fused = False
                         for next_op in op.next:
                             if (
                                 next_op.inst == Instruction.put
+                                and next_op.tb == op.tb
                                 and same_count(op, next_op)
                                 and buf_dst_src_match(op, next_op)
                                 and same_chan_type(op, next_op)
@@ -397,8 +417,7 @@ class MscclppInstructionDAG(InstructionDAG):
                                     )
                                 )
                                 merge_op(op, next_op)
-                                tb.ops.remove(next_op)
-                                queue.remove(next_op)
+                                merged.add(next_op)
                                 fused = True
                                 break
                         if fused:
@@ -408,6 +427,7 @@ class MscclppInstructionDAG(InstructionDAG):
                         for next_op in op.next:
                             if (
                                 next_op.inst == Instruction.put
+                                and next_op.tb == op.tb
                                 and same_count(op, next_op)
                                 and buf_dst_src_match(op, next_op)
                                 and next_op.channel_type == ChannelType.sm
@@ -427,8 +447,7 @@ class MscclppInstructionDAG(InstructionDAG):
                                     )
                                 )
                                 merge_op(op, next_op)
-                                tb.ops.remove(next_op)
-                                queue.remove(next_op)
+                                merged.add(next_op)
                                 fused = True
                                 break
                         if fused:
@@ -438,6 +457,7 @@ class MscclppInstructionDAG(InstructionDAG):
                         for next_op in op.next:
                             if (
                                 next_op.inst == Instruction.put_packet
+                                and next_op.tb == op.tb
                                 and same_count(op, next_op)
                                 and buf_dst_src_match(op, next_op)
                                 and next_op.channel_type == ChannelType.sm
@@ -457,20 +477,22 @@ class MscclppInstructionDAG(InstructionDAG):
                                     )
                                 )
                                 merge_op(op, next_op)
-                                tb.ops.remove(next_op)
-                                queue.remove(next_op)
+                                merged.add(next_op)
                                 fused = True
                                 break
                         if fused:
                             continue
-                    queue = queue[1:]
+                    queue.popleft()
+        self._remove_merged_ops(merged)
 
     # get(src, sbuf. si, dst, dbuf, di) get(src, sbuf, si, dst, dbuf, di) -> get(list[src,sbuf,si], list[dst,dbuf,di])
     # put(src, sbuf, si, dst, dbuf, di) put(src, sbuf, si, dst, dbuf, di) -> put(list[src,sbuf,si], list[dst,dbuf,di])
+    # put_packet(src, sbuf, si, dst, dbuf, di) put_packet(src, sbuf, si, dst, dbuf, di) -> put_packet(list[src,sbuf,si], list[dst,dbuf,di])
     def _optimize_get_put(self):
+        merged = set()
         for rank, rank_tbs in enumerate(self.tbs):
             for tbid, tb in rank_tbs.items():
-                queue = list(tb.ops)
+                queue = deque(tb.ops)
                 while len(queue) > 0:
                     op = queue[0]
                     if op.inst == Instruction.get:
@@ -497,8 +519,8 @@ class MscclppInstructionDAG(InstructionDAG):
                                     )
                                 )
                                 merge_op(op, seq_op)
-                                tb.ops.remove(seq_op)
-                                queue.remove(seq_op)
+                                merged.add(seq_op)
+                                del queue[1]
                                 fused = True
                         if fused:
                             continue
@@ -526,8 +548,8 @@ class MscclppInstructionDAG(InstructionDAG):
                                     )
                                 )
                                 merge_op(op, seq_op)
-                                tb.ops.remove(seq_op)
-                                queue.remove(seq_op)
+                                merged.add(seq_op)
+                                del queue[1]
                                 fused = True
                         if fused:
                             continue
@@ -555,22 +577,24 @@ class MscclppInstructionDAG(InstructionDAG):
                                     )
                                 )
                                 merge_op(op, seq_op)
-                                tb.ops.remove(seq_op)
-                                queue.remove(seq_op)
+                                merged.add(seq_op)
+                                del queue[1]
                                 fused = True
                         if fused:
                             continue
-                    queue = queue[1:]
+                    queue.popleft()
+        self._remove_merged_ops(merged)
 
     # For signal/wait ops, if they are independent of other operations and no other operations in between,
     # then merge them into a single signal/wait op
     # wait(src,sbuf,si,_,_,_) wait(src,sbuf,si,_,_,_) -> wait(list[src,sbuf,si],_,_,_,_])
     def _parallel_signal_wait(self):
+        merged = set()
         for rank, rank_tbs in enumerate(self.tbs):
             for tbid, tb in rank_tbs.items():
                 if tbid == -1:
                     continue
-                queue = list(tb.ops)
+                queue = deque(tb.ops)
                 while len(queue) > 0:
                     op = queue[0]
                     if op.inst == Instruction.signal:
@@ -596,8 +620,8 @@ class MscclppInstructionDAG(InstructionDAG):
                                     )
                                 )
                                 merge_op(op, seq_op)
-                                tb.ops.remove(seq_op)
-                                queue.remove(seq_op)
+                                merged.add(seq_op)
+                                del queue[1]
                                 fused = True
                         if fused:
                             continue
@@ -624,12 +648,13 @@ class MscclppInstructionDAG(InstructionDAG):
                                     )
                                 )
                                 merge_op(op, seq_op)
-                                tb.ops.remove(seq_op)
-                                queue.remove(seq_op)
+                                merged.add(seq_op)
+                                del queue[1]
                                 fused = True
                         if fused:
                             continue
-                    queue = queue[1:]
+                    queue.popleft()
+        self._remove_merged_ops(merged)
 
     def _get_tb_step(self, rank: int, tb: int):
         if tb in self.tb_steps[rank]:
@@ -662,18 +687,11 @@ class MscclppInstructionDAG(InstructionDAG):
         for _ in range(self.num_ranks):
             self.instanced_tbs.append({})
 
-        def is_scratch(buffer):
-            return buffer != Buffer.input and buffer != Buffer.output
-
-        def get_new_index(rank, buffer, index, size, i):
-            # Scratch buffers always use batched
-            if is_scratch(buffer):
-                buf_instance_len = self.buffers[rank][buffer].instance_size()
-                return buf_instance_len * i + index
-            return len(self.buffers[rank][buffer]) * i + index
+        # All buffers use batched replication
+        buffer_lens = self._get_buffer_lens()
 
         def get_instance_ref(ref):
-            iindex = get_new_index(ref.rank, ref.buffer, ref.index, ref.size, i)
+            iindex = buffer_lens[(ref.rank, ref.buffer)] * i + ref.index
             iref = ChunkRef(ref.rank, ref.buffer, iindex, ref.size)
             return iref
 
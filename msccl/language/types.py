@@ -1,13 +1,27 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
 from enum import Enum
+from itertools import count
 from typing import Union
 
 from msccl.language.buffer import Buffer
 
 
+# Rebuilds a dataclass with __slots__ for its fields, dataclass(slots=True) needs Python 3.10
+# Fields with init=False must use a default_factory since class level defaults are dropped
+def _add_slots(cls):
+    cls_dict = dict(cls.__dict__)
+    field_names = tuple(f.name for f in fields(cls))
+    cls_dict["__slots__"] = field_names
+    for name in field_names:
+        cls_dict.pop(name, None)
+    cls_dict.pop("__dict__", None)
+    cls_dict.pop("__weakref__", None)
+    return type(cls)(cls.__name__, cls.__bases__, cls_dict)
+
+
 @dataclass
 class Program:
     name: str
@@ -38,6 +52,7 @@ class Gpu:
         return max((idx for addr, idx in self.scratch.items()), default=-1) + 1
 
 
+@_add_slots
 @dataclass
 class Threadblock:
     channel: int = -1
@@ -124,6 +139,7 @@ class MscclppInstruction(Enum):
         return self.value
 
 
+@_add_slots
 @dataclass
 class ChunkRef:
     rank: int
@@ -152,6 +168,10 @@ class Channel:
     connected_to: int
 
 
+_op_ids = count()
+
+
+@_add_slots
 @dataclass
 class Op:
     inst: Union[Instruction, MscclppInstruction]
@@ -161,27 +181,35 @@ class Op:
     depends: list = field(default_factory=list)
     step: int = -1  # Step in the TB
     tb: int = -1  # TB this op is assigned to
-    prev: list = field(default_factory=list)  # List of instructions that happen before
-    next: list = field(default_factory=list)  # List of instructions that happen after
+    prev: set = None  # Set of instructions that happen before, None for ops outside the DAG
+    next: set = None  # Set of instructions that happen after
     num: int = -1
     chunk_step: int = -1
     priority: int = -1
-    recv_match = None
-    send_match = None
     channel: int = -1
     channel_type: ChannelType = ChannelType.none
     srcs: list = field(default_factory=list)
     dsts: list = field(default_factory=list)
+    recv_match: "Op" = None  # Matching receive of a send, the cross-rank edge of the DAG
+    send_match: "Op" = None  # Matching send of a receive
+    id: int = field(default_factory=_op_ids.__next__, init=False, repr=False)  # Unique id used for hashing
+    _cnt: int = field(default_factory=lambda: None, init=False, repr=False)
 
+    # Memoized, call reset_cnt after reassigning src or dst to a ref of a different size
     def cnt(self):
-        if self.src:
-            if self.dst:
-                assert self.src.size == self.dst.size
-            return self.src.size
-        elif self.dst:
-            return self.dst.size
-        else:
-            return 0
+        if self._cnt is None:
+            if self.src:
+                if self.dst:
+                    assert self.src.size == self.dst.size
+                self._cnt = self.src.size
+            elif self.dst:
+                self._cnt = self.dst.size
+            else:
+                self._cnt = 0
+        return self._cnt
+
+    def reset_cnt(self):
+        self._cnt = None
 
     def is_send(self):
         return (
@@ -244,7 +272,7 @@ class Op:
         return not self < other
 
     def __hash__(self):
-        return id(self)
+        return self.id
 
     def __repr__(self):
         return f"Op({self.inst}, {self.rank}, {self.src}, {self.dst}, step:{self.step}, tb:{self.tb})"
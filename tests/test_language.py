@@ -2,7 +2,8 @@
 # Licensed under the MIT License.
 
 import msccl
-from msccl.language.types import MscclppInstruction
+from msccl.language.instruction_dag import circular_dep_after_merge
+from msccl.language.types import ChunkRef, MscclppInstruction, Op
 from msccl.topologies import line, fully_connected
 from msccl.language import *
 from msccl.language.routines import *
@@ -152,8 +153,42 @@ def test_program_order():
     prgm.lower()
     op = prgm.instr_dag.operations[slot]
     assert op.inst == Instruction.start
-    assert op.next[0].inst == Instruction.send
-    assert op.next[0].next[0].inst == Instruction.recv
+    send_op = next(iter(op.next))
+    assert send_op.inst == Instruction.send
+    assert next(iter(send_op.next)).inst == Instruction.recv
+
+
+def test_op_cnt():
+    op = Op(Instruction.send, 0, ChunkRef(0, Buffer.input, 0, 2), ChunkRef(1, Buffer.input, 0, 2))
+    assert op.cnt() == 2
+    op.src = None
+    op.dst = ChunkRef(1, Buffer.input, 0, 3)
+    op.reset_cnt()
+    assert op.cnt() == 3
+
+
+def test_op_slots():
+    op = Op(Instruction.send, 0, None, None)
+    assert not hasattr(op, "__dict__")
+    assert hash(op) == op.id and op.id != Op(Instruction.send, 0, None, None).id
+
+
+def test_circular_dep_after_merge():
+    def link(a, b):
+        a.next.add(b)
+        b.prev.add(a)
+
+    op, x, y, other_op = [Op(MscclppInstruction.put, 0, None, None, next=set(), prev=set()) for _ in range(4)]
+    # op -> other_op is the only edge out of op
+    link(op, other_op)
+    link(y, other_op)
+    assert not circular_dep_after_merge(op, other_op)
+    # op -> x -> other_op would become a cycle through the merged op
+    link(op, x)
+    link(x, other_op)
+    assert circular_dep_after_merge(op, other_op)
+    # op -> x is the only edge into x
+    assert not circular_dep_after_merge(op, x)
 
 
 def test_allgather():
@@ -211,6 +246,22 @@ def test_instruction_fusion():
     assert lowered_prgm.gpus[2].threadblocks[0].ops[0].inst == Instruction.recv_reduce_copy_send
 
 
+def test_instruction_fusion_rrs_before_rcs():
+    topology = fully_connected(3)
+    collective = AllReduce(3, 2, True)
+    prgm = MSCCLProgram("allreduce", topology, collective, 1)
+    # The recv overwriting the rrc's send is reached first through input[0] and fused into an rcs
+    # The rrc must still become an rrs
+    with prgm:
+        chunk(1, Buffer.input, 1).reduce(chunk(0, Buffer.input, 1)).copy(2, Buffer.input, 1)
+        chunk(0, Buffer.input, 0, 2).copy(1, Buffer.input, 0)
+        chunk(1, Buffer.input, 0, 2).copy(2, Buffer.input, 0)
+    lowered_prgm = prgm.lower()
+    ops = lowered_prgm.gpus[1].threadblocks[0].ops
+    assert ops[0].inst == Instruction.recv_reduce_send
+    assert ops[1].inst == Instruction.recv_copy_send
+
+
 def test_instruction_fusion_mscclpp():
     topology = fully_connected(3)
     collective = AllReduce(3, 3, True)
@@ -265,6 +316,21 @@ def test_instruction_fusion_multi_deps_mscclpp():
     assert lowered_prgm.gpus[1].threadblocks[0].ops[1].inst == MscclppInstruction.reduce_packet
 
 
+def test_instruction_fusion_cross_tb_mscclpp():
+    topology = fully_connected(2)
+    collective = AllReduce(2, 2, True)
+    prgm = MSCCLPPProgram("allreduce", topology, collective, 1)
+    # reduce and put are assigned different threadblocks and must not be fused
+    with prgm:
+        c = chunk(0, Buffer.input, 0)
+        c.reduce(chunk(0, Buffer.input, 1), recvtb=0)
+        c.put(1, Buffer.input, 0, sendtb=1)
+    lowered_prgm = prgm.lower()
+    tbs = {tb.id: tb for tb in lowered_prgm.gpus[0].threadblocks}
+    assert [op.inst for op in tbs[0].ops] == [MscclppInstruction.reduce]
+    assert [op.inst for op in tbs[1].ops] == [MscclppInstruction.put]
+
+
 def test_replication():
     topology = fully_connected(2)
     collective = AllToAll(2, 1, False)